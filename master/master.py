@@ -1,41 +1,318 @@
 import asyncio
+import atexit
+import bisect
+import itertools
 import logging
+import operator
+import os
+import queue
+import random
 import threading
-from typing import List
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from typing import Deque, Dict, List, Optional, Set
 
-from flask import Flask, request, jsonify
+from quart import Quart, Response, request, jsonify
 import httpx
+import orjson
 
 # -------------------------------
 # Налаштування логування
 # -------------------------------
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [MASTER] %(message)s")
-
-app = Flask(__name__)
+# Обробники лише кладуть записи в чергу; запис у stderr робить окремий потік
+# QueueListener, тож логування не блокує event loop.
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s [MASTER] %(message)s"))
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[QueueHandler(_log_queue)])
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+app = Quart(__name__)
 
 # -------------------------------
 # Локальне сховище повідомлень
 # -------------------------------
 messages: List[dict] = []      # [{id, text}]
 messages_lock = threading.Lock()
-next_id = 1                    # глобальний порядковий номер повідомлення
-counter_lock = threading.Lock()
-pending: List[tuple] = []       # список Secondary, яким потрібно догнати реплікацію
+messages_snapshot: Optional[tuple] = ()  # знімок для читачів; None — застарів після запису
+_id_gen = itertools.count(1)   # глобальний порядковий номер повідомлення (next() атомарний)
+_id_key = operator.itemgetter("id")  # ключ пошуку в журналі за id
+pending: Dict[str, Deque[dict]] = {}  # url -> повідомлення, які Secondary ще має отримати
+pending_ids: Dict[str, Set[int]] = {}  # url -> id цих повідомлень (дедуплікація за O(1))
 pending_lock = threading.Lock()
+background_tasks: Set[asyncio.Task] = set()  # фонові задачі (consumer-и реплікації)
+resending: Set[str] = set()  # url Secondary, яким зараз дозвідправляється журнал (/pending)
 
 SECONDARIES = ["http://secondary1:5000", "http://secondary2:5000"]
 
+# -------------------------------
+# Черги реплікації: по одній на Secondary
+# -------------------------------
+# Елемент черги: (повідомлення, його JSON-байти, Future[bool] з результатом доставки
+# або None, якщо ніхто не чекає на ACK — як при w=1)
+queues: Dict[str, asyncio.Queue] = {}
+# Межа черги: якщо Secondary не встигає, записи, яким потрібен його ACK, отримують 503;
+# решта (зокрема w=1) іде в pending
+WORKER_QUEUE_MAX = int(os.getenv("WORKER_QUEUE_MAX", "10000"))
+
+# Експоненційний backoff з decorrelated jitter для повторних спроб доставки
+RETRY_BASE_DELAY = 0.5   # с
+RETRY_MAX_DELAY = 5.0    # с
+RETRY_MAX_ATTEMPTS = 8   # після цього повідомлення переходить у pending
+
+# Максимальний розмір пакета: consumer забирає з черги все, що накопичилось
+# (але не більше), і відправляє одним POST /replicate_batch
+BATCH_MAX_SIZE = 64
+
+# Як часто фонова задача дозвідправляє pending на Secondary, с
+PENDING_RETRY_INTERVAL = 5.0
+# Межа pending для одного Secondary: понад неї витісняється найстаріше повідомлення
+# (Secondary дозапитає його з журналу Master), тож w=1 не відхиляється ніколи
+PENDING_MAX = int(os.getenv("PENDING_MAX", "10000"))
+
+# Після стількох невдалих спроб поспіль Secondary вважається недоступним:
+# post_message не чекає від нього ACK, доки він знову не відповість
+UNHEALTHY_AFTER_FAILURES = 3
+_consecutive_failures: Dict[str, int] = {}
+unhealthy_secondaries: Set[str] = set()
+# url -> Future ACK, на які ще чекають обробники; коли Secondary стає недоступним,
+# вони одразу завершуються з False, а не чекають весь цикл повторних спроб
+_ack_waiters: Dict[str, Set[asyncio.Future]] = {}
+
+# Скільки post_message загалом чекає ACK від Secondary, с
+MASTER_WAIT_TIMEOUT = float(os.getenv("MASTER_WAIT_TIMEOUT", "10"))
+
+# -------------------------------
+# HTTP-клієнти для реплікації
+# -------------------------------
+# Усі обробники працюють в одному event loop Quart, тож клієнти (пули з'єднань
+# + keep-alive) живуть весь час роботи процесу. Кожен Secondary має власний пул,
+# щоб повільний Secondary не забирав з'єднання в інших; HTTP — для адрес
+# поза SECONDARIES (наприклад, з /pending).
+HTTP = httpx.AsyncClient(timeout=5.0, limits=httpx.Limits(max_keepalive_connections=32))
+SECONDARY_LIMITS = httpx.Limits(max_connections=8, max_keepalive_connections=8)
+_CLIENTS: Dict[str, httpx.AsyncClient] = {}
+# Тіло запиту передаємо готовими байтами (content=...), тому заголовок ставимо самі
+_JSON_HEADERS = {"content-type": "application/json"}
+
+
+@app.after_serving
+async def close_http_clients():
+    for client in _CLIENTS.values():
+        await client.aclose()
+    await HTTP.aclose()
+
+
+def _client_for(url: str) -> httpx.AsyncClient:
+    return _CLIENTS.get(url, HTTP)
+
 
 def _drain_task_result(task: asyncio.Task) -> None:
     """Helper to log exceptions from background replication tasks."""
     try:
         exc = task.exception()
         if exc is not None:
-            logging.warning(f"Помилка реплікації у фоновому режимі: {exc}")
+            logging.warning("Помилка реплікації у фоновому режимі: %s", exc)
     except asyncio.CancelledError:
         logging.warning("Фонова задача реплікації була скасована")
+    finally:
+        background_tasks.discard(task)
+
+
+@app.before_serving
+async def start_replication_consumers():
+    """
+    Створює клієнт і запускає по одному consumer-у на кожен Secondary,
+    а також фонову задачу повторної доставки pending.
+    """
+    for sec in SECONDARIES:
+        _CLIENTS[sec] = httpx.AsyncClient(timeout=5.0, limits=SECONDARY_LIMITS)
+        queues[sec] = asyncio.Queue(maxsize=WORKER_QUEUE_MAX)
+        _ack_waiters[sec] = set()
+        _start_background(_secondary_consumer(sec))
+    _start_background(_pending_retry_loop())
+
+
+def _start_background(coro) -> None:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_drain_task_result)
+
+
+async def _secondary_consumer(url: str) -> None:
+    """
+    Єдиний consumer черги Secondary: доставляє повідомлення по порядку
+    з повторними спробами і записує результат доставки у Future.
+    Поки Secondary швидкий, пакети складаються з одного повідомлення;
+    коли повільний — у черзі накопичується більше, і вони йдуть одним запитом.
+    Повільний Secondary блокує лише власну чергу, а не обробник запиту.
+    Якщо всі спроби вичерпано, повідомлення переходять у pending,
+    щоб мертвий Secondary не тримав чергу вічно. Для Secondary, уже позначеного
+    недоступним, спроб немає зовсім: пакет одразу йде в pending, а повертає
+    Secondary до життя фонова доставка pending.
+    """
+    queue = queues[url]
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < BATCH_MAX_SIZE:
+            try:
+                batch.append(queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        batch_msgs = [msg for msg, _, _ in batch]
+        if url in unhealthy_secondaries:
+            ok = False
+        else:
+            ok = await _retrying_post(url, [body for _, body, _ in batch])
+            if not ok:
+                logging.warning(
+                    "Secondary %s не підтвердив пакет з %d повідомлень після %d спроб",
+                    url, len(batch_msgs), RETRY_MAX_ATTEMPTS,
+                )
+        if not ok:
+            for msg in batch_msgs:
+                _enqueue_pending(url, msg)
+
+        for _, _, ack in batch:
+            if ack is not None and not ack.done():
+                ack.set_result(ok)
+
+
+async def _retrying_post(
+    url: str,
+    bodies: List[bytes],
+    base: float = RETRY_BASE_DELAY,
+    cap: float = RETRY_MAX_DELAY,
+    max_attempts: int = RETRY_MAX_ATTEMPTS,
+) -> bool:
+    """
+    Доставка з повторними спробами: decorrelated jitter
+    (delay = min(cap, uniform(base, delay * 3))), щоб після рестарту
+    Secondary повтори різних повідомлень не синхронізувались.
+    """
+    payload = _batch_payload(bodies)
+    delay = base
+    for attempt in range(max_attempts):
+        if await _send_batch_to_secondary(url, payload, len(bodies)):
+            return True
+        if attempt + 1 < max_attempts:
+            delay = min(cap, random.uniform(base, delay * 3))
+            await asyncio.sleep(delay)
+    return False
+
+
+async def _wait_for_acks(acks: List[asyncio.Future], required: int) -> int:
+    """
+    Чекає, доки щонайменше required Secondary підтвердять запис
+    (або доставка на решту остаточно не вдасться, або мине MASTER_WAIT_TIMEOUT),
+    і повертає кількість ACK.
+    Future належать consumer-ам, тому окремих задач-очікувачів немає
+    і скасовувати після виходу нічого не потрібно.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + MASTER_WAIT_TIMEOUT
+    confirmed = 0
+    waiting = set(acks)
+    while waiting and confirmed < required:
+        done, waiting = await asyncio.wait(
+            waiting, timeout=deadline - loop.time(), return_when=asyncio.FIRST_COMPLETED,
+        )
+        if not done:
+            logging.warning("Не дочекався ACK за %.1fs", MASTER_WAIT_TIMEOUT)
+            break
+        confirmed += sum(1 for ack in done if ack.result())
+    return confirmed
+
+
+def _enqueue_replication(url: str, msg: dict, body: bytes, ack: Optional[asyncio.Future]) -> None:
+    """
+    Ставить повідомлення в чергу consumer-а Secondary.
+    Якщо черга переповнена, повідомлення йде одразу в pending
+    (його дозвідправить фонова задача), а ACK вважається неотриманим.
+    """
+    try:
+        queues[url].put_nowait((msg, body, ack))
+    except asyncio.QueueFull:
+        _enqueue_pending(url, msg)
+        if ack is not None:
+            ack.set_result(False)
+
+
+def _enqueue_pending(url: str, msg: dict) -> None:
+    """
+    Додає повідомлення в pending для Secondary, якщо його там ще немає.
+    Понад PENDING_MAX витісняємо найстаріше повідомлення, тож пам'ять обмежена,
+    а запис на Master не відхиляється. Витіснене повідомлення є в журналі
+    Master: Secondary отримає новіші, побачить пропуск
+    і дозапитає його (repair_gap) або отримає з /pending після рестарту.
+    """
+    with pending_lock:
+        ids = pending_ids.setdefault(url, set())
+        if msg["id"] in ids:
+            return
+        queue = pending.setdefault(url, deque())
+        if len(queue) >= PENDING_MAX:
+            ids.discard(queue.popleft()["id"])
+        ids.add(msg["id"])
+        queue.append(msg)
+
+
+async def _pending_retry_loop() -> None:
+    """
+    Раз на PENDING_RETRY_INTERVAL дозвідправляє pending кожному Secondary.
+    Це єдине місце, де pending вичитується, тож черга кожного Secondary
+    дренується не більше ніж однією корутиною одночасно.
+    """
+    while True:
+        await asyncio.sleep(PENDING_RETRY_INTERVAL)
+        for sec in SECONDARIES:
+            if pending.get(sec):
+                await _flush_pending_queue(sec)
+
+
+async def _flush_pending_queue(url: str) -> None:
+    """
+    Дозвідправляє pending для Secondary пакетами з голови черги.
+    Після успішної відправки знімаємо пакет через popleft (O(1) на повідомлення);
+    на першій невдачі зупиняємось — решта лишається до наступної спроби.
+    Поки пакет летів, _enqueue_pending міг витіснити його початок, тож знімаємо
+    лише ті повідомлення, які ще стоять у голові.
+    """
+    while True:
+        with pending_lock:
+            queue = pending.get(url)
+            if not queue:
+                return
+            head = list(itertools.islice(queue, BATCH_MAX_SIZE))
+        payload = _batch_payload([orjson.dumps(msg) for msg in head])
+        if not await _send_batch_to_secondary(url, payload, len(head)):
+            return
+        with pending_lock:
+            ids = pending_ids[url]
+            for msg in head:
+                if queue and queue[0] is msg:
+                    queue.popleft()
+                    ids.discard(msg["id"])
 
 
+def _messages_snapshot() -> tuple:
+    """
+    Незмінний знімок журналу для читачів (copy-on-write).
+    Читання без lock: беремо поточний кортеж; lock потрібен лише першому
+    читачеві після запису, щоб зібрати новий знімок.
+    """
+    global messages_snapshot
+    snapshot = messages_snapshot
+    if snapshot is None:
+        with messages_lock:
+            if messages_snapshot is None:
+                messages_snapshot = tuple(messages)
+            snapshot = messages_snapshot
+    return snapshot
+
 
 @app.route("/message", methods=["POST"])
 async def post_message():
@@ -46,10 +323,17 @@ async def post_message():
     3. Реплікуємо на secondary.
     4. Чекаємо підтверджень (залежно від w).
     """
-    global next_id
+    global messages_snapshot
 
-    data = request.get_json() or {}
+    data = await request.get_json() or {}
     text = data.get("text")
+    # Серіалізуємо текст до видачі id: якщо orjson не може його закодувати
+    # (наприклад, ціле поза 64 біт), запит відхиляється і id не витрачається
+    try:
+        text_json = orjson.dumps(text)
+    except orjson.JSONEncodeError as e:
+        logging.warning("Не вдалося серіалізувати повідомлення: %s", e)
+        return jsonify({"status": "error", "error": "invalid text"}), 400
 
     total_replicas = len(SECONDARIES) + 1
     requested_w = data.get("w")
@@ -59,76 +343,127 @@ async def post_message():
         requested_w = int(requested_w)
         if requested_w > total_replicas:
             logging.warning(
-                f"Запитаний рівень write concern {requested_w} перевищує доступні репліки, "
-                f"використовую {total_replicas}"
+                "Запитаний рівень write concern %d перевищує доступні репліки, використовую %d",
+                requested_w, total_replicas,
             )
         w = max(1, min(requested_w, total_replicas))
 
-    with counter_lock:
-        msg_id = next_id
-        next_id += 1
+    ack_count = 1  # master вже зарахований
+    ack_target = w
+
+    # Недоступні Secondary отримають повідомлення у фоні, але ACK від них не чекаємо.
+    # ACK можуть дати лише ті, чия черга не переповнена.
+    live = [sec for sec in SECONDARIES if sec not in unhealthy_secondaries]
+    ready = [sec for sec in live if not queues[sec].full()]
+    required = min(ack_target - ack_count, len(live))
+    if len(ready) < required:
+        # Backpressure: відмовляємо до запису, щоб клієнт міг безпечно повторити
+        logging.warning("Черги реплікації переповнені, відхиляю запис з w=%d", w)
+        return jsonify({"status": "error", "error": "backpressure"}), 503
+
+    msg_id = next(_id_gen)
 
     msg = {"id": msg_id, "text": text}
+    # JSON збираємо з готових байтів тексту — один раз для всіх Secondary
+    body = b'{"id":%d,"text":%b}' % (msg_id, text_json)
 
     # 1. Запис на master
     with messages_lock:
         messages.append(msg)
-    logging.info(f"Отримав повідомлення {msg}, w={w}")
-
-    # 2. Реплікація на Secondaries
-    tasks = []
+        messages_snapshot = None
+    logging.info("Отримав повідомлення %s, w=%d", msg, w)
+
+    # 2. Реплікація на Secondaries: ставимо повідомлення в черги consumer-ів
+    if required == 0:
+        # Для w=1 вистачає ACK від master: доставка йде у фоні, Future не потрібні
+        for sec in SECONDARIES:
+            _enqueue_replication(sec, msg, body, None)
+        logging.info("ACK отримано: %d/%d", ack_count, ack_target)
+        return jsonify({"status": "ok", "acks": ack_count, "msg": msg})
+
+    loop = asyncio.get_running_loop()
+    acks = []
     for sec in SECONDARIES:
-        task = asyncio.create_task(replicate_to_secondary(sec, msg))
-        task.add_done_callback(_drain_task_result)
-        tasks.append(task)
+        ack = None
+        if sec in ready:
+            ack = loop.create_future()
+            acks.append(ack)
+            waiters = _ack_waiters[sec]
+            waiters.add(ack)
+            ack.add_done_callback(waiters.discard)
+        _enqueue_replication(sec, msg, body, ack)
 
     # 3. Чекаємо потрібну кількість ACK
-    ack_count = 1  # master вже зарахований
-    ack_target = w
-
-    if ack_count < ack_target and tasks:
-        for future in asyncio.as_completed(tasks):
-            try:
-                result = await future
-            except Exception as exc:
-                logging.warning(f"Помилка реплікації: {exc}")
-                result = False
+    if required == len(acks):
+        # Потрібні всі доступні Secondary — просто чекаємо на всіх, без раннього виходу
+        done, _ = await asyncio.wait(acks, timeout=MASTER_WAIT_TIMEOUT)
+        if len(done) < len(acks):
+            logging.warning("Не дочекався ACK за %.1fs", MASTER_WAIT_TIMEOUT)
+        ack_count += sum(1 for ack in done if ack.result())
+    else:
+        ack_count += await _wait_for_acks(acks, required)
 
-            if result:
-                ack_count += 1
+    logging.info("ACK отримано: %d/%d", ack_count, ack_target)
 
-            if ack_count >= ack_target:
-                break
+    return jsonify({"status": "ok", "acks": ack_count, "msg": msg})
 
-    logging.info(f"ACK отримано: {ack_count}/{ack_target}")
 
-    return jsonify({"status": "ok", "acks": ack_count, "msg": msg})
+def _batch_payload(bodies: List[bytes]) -> bytes:
+    """Тіло POST /replicate_batch з уже серіалізованих повідомлень."""
+    return b'{"messages":[' + b",".join(bodies) + b"]}"
 
 
-async def replicate_to_secondary(url, msg):
-    """
-    Відправка повідомлення на secondary.
-    Якщо secondary недоступний, додаємо його в pending.
-    """
+async def _send_batch_to_secondary(url: str, payload: bytes, size: int) -> bool:
+    """Одна спроба відправити пакет з size повідомлень (готовий JSON) на secondary."""
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.post(f"{url}/replicate", json=msg, timeout=5.0)
-            if r.status_code == 200:
-                logging.info(f"Успішна реплікація на {url} -> {msg}")
-                return True
+        r = await _client_for(url).post(f"{url}/replicate_batch", content=payload, headers=_JSON_HEADERS)
+        if r.status_code == 200:
+            logging.info("Успішна реплікація пакета з %d повідомлень на %s", size, url)
+            _record_delivery(url, True)
+            return True
+        logging.warning("Secondary %s відповів %d на пакет з %d повідомлень", url, r.status_code, size)
     except Exception as e:
-        logging.warning(f"Помилка реплікації на {url}: {e}")
-        with pending_lock:
-            pending.append((url, msg))
+        logging.warning("Помилка реплікації пакета на %s: %s", url, e)
+    _record_delivery(url, False)
     return False
 
 
+def _record_delivery(url: str, ok: bool) -> None:
+    """Оновлює стан Secondary після спроби доставки."""
+    if ok:
+        _consecutive_failures[url] = 0
+        if url in unhealthy_secondaries:
+            unhealthy_secondaries.discard(url)
+            logging.info("Secondary %s знову доступний", url)
+        return
+    failures = _consecutive_failures.get(url, 0) + 1
+    _consecutive_failures[url] = failures
+    if failures >= UNHEALTHY_AFTER_FAILURES and url not in unhealthy_secondaries:
+        unhealthy_secondaries.add(url)
+        logging.warning("Secondary %s позначено недоступним після %d невдач поспіль", url, failures)
+        # Ті, хто вже чекає ACK від цього Secondary, отримують відмову одразу
+        for ack in list(_ack_waiters.get(url, ())):
+            if not ack.done():
+                ack.set_result(False)
+
+
+def _json(data) -> Response:
+    """JSON-відповідь через orjson (швидше за jsonify на великих списках)."""
+    return Response(orjson.dumps(data), mimetype="application/json")
+
+
 @app.route("/messages", methods=["GET"])
-def get_messages():
-    """Повертає всі повідомлення на master"""
-    with messages_lock:
-        snapshot = list(messages)
-    return jsonify(snapshot)
+async def get_messages():
+    """
+    Повертає всі повідомлення на master.
+    ?from_id=N — лише з id >= N (так Secondary дозапитує пропущене).
+    """
+    snapshot = _messages_snapshot()
+    from_id = request.args.get("from_id", type=int)
+    if from_id is not None:
+        # Журнал відсортований за id, але в ньому можуть бути пропуски — шукаємо за значенням
+        snapshot = snapshot[bisect.bisect_left(snapshot, from_id, key=_id_key):]
+    return _json(snapshot)
 
 
 @app.route("/pending", methods=["POST"])
@@ -136,19 +471,40 @@ async def resend_pending():
     """
     Secondary викликає цей метод при рестарті,
     щоб отримати "втрачені" повідомлення.
+    Відповідаємо одразу (202), а журнал дозвідправляє фонова задача:
+    з повільним Secondary (REPLICA_DELAY) це займає довше за таймаут запиту.
+    Для одного url одночасно працює не більше однієї такої задачі.
     """
-    data = request.get_json()
+    data = await request.get_json()
     url = data.get("url")
-    logging.info(f"Secondary {url} запросив pending")
+    if url in resending:
+        logging.info("Secondary %s запросив pending, дозвідправка вже триває", url)
+        return jsonify({"status": "resend in progress"}), 202
 
-    with messages_lock:
-        snapshot = list(messages)
+    logging.info("Secondary %s запросив pending", url)
+    resending.add(url)
+    _start_background(_resend_log(url))
+    return jsonify({"status": "resend started"}), 202
 
-    for msg in snapshot:
-        await replicate_to_secondary(url, msg)
 
-    return jsonify({"status": "resend complete"})
+async def _resend_log(url: str) -> None:
+    """
+    Відправляє Secondary весь журнал пакетами; дублі Secondary відкине сам.
+    Кожен пакет — з повторними спробами; якщо пакет так і не дійшов,
+    зупиняємось: Secondary знову попросить pending або дозапитає пропуск.
+    """
+    try:
+        snapshot = _messages_snapshot()
+        for start in range(0, len(snapshot), BATCH_MAX_SIZE):
+            chunk = snapshot[start:start + BATCH_MAX_SIZE]
+            if not await _retrying_post(url, [orjson.dumps(msg) for msg in chunk]):
+                logging.warning("Дозвідправку журналу на %s перервано на id %d", url, chunk[0]["id"])
+                return
+        logging.info("Журнал з %d повідомлень дозвідправлено на %s", len(snapshot), url)
+    finally:
+        resending.discard(url)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True, threaded=True)
+    # У контейнері master запускається через hypercorn (див. Dockerfile.master)
+    app.run(host="0.0.0.0", port=5000)
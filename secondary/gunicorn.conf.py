@@ -0,0 +1,10 @@
+# Хуки gunicorn для Secondary (див. Dockerfile.secondary)
+
+
+def post_worker_init(worker):
+    # Фонові задачі (синхронізація з Master, перевірка пропусків) стартують у воркері,
+    # а не під час імпорту модуля: так їх немає в master-процесі gunicorn (--preload)
+    import secondary
+
+    secondary.schedule_pending_sync()
+    secondary.schedule_gap_repair()
@@ -1,64 +1,318 @@
 import os
 import time
+import random
+import queue
+import atexit
+import heapq
 import logging
 import threading
-from typing import List
+from logging.handlers import QueueHandler, QueueListener
+from typing import List, Set
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
+import httpx
+import orjson
 
 # -------------------------------
 # Налаштування логування
 # -------------------------------
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [SECONDARY] %(message)s")
+# Обробники лише кладуть записи в чергу; запис у stderr робить окремий потік
+# QueueListener, тож логування не подовжує обробку запитів і утримання lock.
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s [SECONDARY] %(message)s"))
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[QueueHandler(_log_queue)])
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON-провайдер Flask на orjson: і для request.get_json(), і для jsonify."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs) -> Response:
+        # Віддаємо байти orjson напряму, без проміжного str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # -------------------------------
 # Локальне сховище
 # -------------------------------
-messages: List[dict] = []  # [{id, text}]
+messages: List[dict] = []  # [{id, text}] — лише неперервний префікс журналу (id 1..next_expected_id-1)
+message_ids: Set[int] = set()  # id усіх отриманих повідомлень: записаних і в буфері (дедуплікація за O(1))
+pending_heap: List[tuple] = []  # min-heap (id, msg): прийшли раніше за попередні, чекають на пропуск
+next_expected_id = 1  # id наступного повідомлення, яке можна показати
 messages_lock = threading.Lock()
+messages_snapshot: tuple = ()  # знімок для читачів; застарів, якщо коротший за messages
+_messages_json_cache: tuple = ((), b"[]")  # (знімок, його JSON) — кодуємо один раз на знімок
 
 # Затримка для емуляції inconsistency
 REPLICA_DELAY = int(os.getenv("REPLICA_DELAY", "0"))
 
+# -------------------------------
+# Синхронізація з Master при старті
+# -------------------------------
+MASTER_URL = os.getenv("MASTER_URL", "http://master:5000")
+SELF_URL = os.getenv("SELF_URL")  # адреса, за якою Master бачить цей Secondary
+SYNC_MAX_ATTEMPTS = 10
+SYNC_RETRY_DELAY = 2.0  # база експоненційного backoff, с
+SYNC_MAX_DELAY = 30.0   # верхня межа паузи між спробами, с
+# Як часто перевіряти, чи не застряг пропуск перед pending_heap, с
+GAP_REPAIR_INTERVAL = 5.0
+_gap_repair_stop = threading.Event()  # ніхто не встановлює: потік живе, доки живе процес
+
+# Один клієнт на весь процес: повторні спроби використовують уже відкриті з'єднання
+_client = httpx.Client(timeout=10.0, limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+atexit.register(_client.close)
+
+
+def _insert_locked(msg: dict) -> bool:
+    """
+    Приймає повідомлення, якщо його ще немає. Викликати під messages_lock.
+    Total ordering: повідомлення з'являється в messages лише тоді, коли записані
+    всі попередні; до того воно чекає в pending_heap (пропуск, що не закривається
+    сам, дозапитує repair_gap).
+    Повертає True, якщо повідомлення нове.
+    """
+    global next_expected_id
+    msg_id = msg["id"]
+    if msg_id in message_ids:
+        return False
+    message_ids.add(msg_id)
+
+    if msg_id < next_expected_id:
+        # id уже пропущено (_skip_gap_locked): показати його на своєму місці не можна,
+        # а в буфері він назавжди заблокував би корінь pending_heap
+        logging.warning("Ігноровано запізніле повідомлення %s: id вже пропущено", msg)
+        return False
+
+    if msg_id != next_expected_id:
+        heapq.heappush(pending_heap, (msg_id, msg))
+        return True
+
+    messages.append(msg)
+    next_expected_id += 1
+    _drain_heap_locked()
+    return True
+
+
+def _drain_heap_locked() -> None:
+    """Пропуск закрито — переносимо з буфера все, що тепер іде підряд. Під messages_lock."""
+    global next_expected_id
+    while pending_heap and pending_heap[0][0] == next_expected_id:
+        _, buffered = heapq.heappop(pending_heap)
+        messages.append(buffered)
+        next_expected_id += 1
+
+
+def _skip_gap_locked(to_id: int) -> None:
+    """
+    Пропускає id від next_expected_id до to_id: Master їх не має (id був виданий,
+    але запис не відбувся), тож самі вони ніколи не прийдуть. Під messages_lock.
+    """
+    global next_expected_id
+    logging.warning("Master не має id %d..%d — пропускаю їх", next_expected_id, to_id - 1)
+    next_expected_id = to_id
+    _drain_heap_locked()
+
+
+def _messages_snapshot() -> tuple:
+    """
+    Кортеж-знімок для GET /messages, зовсім без messages_lock.
+    messages лише дописується в кінець, тож довжина — це версія журналу:
+    знімок актуальний, поки його довжина збігається з len(messages).
+    tuple(list) копіюється атомарно під GIL і дає неперервний префікс.
+    Гонка двох читачів лише змусить когось перебудувати знімок ще раз.
+    """
+    global messages_snapshot
+    snapshot = messages_snapshot
+    if len(snapshot) != len(messages):
+        snapshot = tuple(messages)
+        messages_snapshot = snapshot
+    return snapshot
+
+
+def _messages_json() -> bytes:
+    """
+    JSON поточного знімка. Кодуємо лише тоді, коли знімок змінився
+    (тобто після нового запису); інакше віддаємо готові байти.
+    """
+    global _messages_json_cache
+    snapshot = _messages_snapshot()
+    cached_snapshot, body = _messages_json_cache
+    if cached_snapshot is not snapshot:
+        body = orjson.dumps(snapshot)
+        _messages_json_cache = (snapshot, body)
+    return body
+
+
+def _replica_delay() -> None:
+    """Штучна затримка перед записом (емуляція повільної репліки)."""
+    if REPLICA_DELAY > 0:
+        logging.info("Затримка %ss перед записом...", REPLICA_DELAY)
+        time.sleep(REPLICA_DELAY)
+
 
 @app.route("/replicate", methods=["POST"])
 def replicate():
     """
     Secondary отримує повідомлення від Master.
     - додає його у список, якщо ще немає (deduplication)
-    - сортує список за id (total ordering)
+    - показує його лише після всіх попередніх (total ordering)
     - може затримати ACK (щоб показати блокування / eventual consistency)
     """
     msg = request.get_json()
 
-    # Штучна затримка
-    if REPLICA_DELAY > 0:
-        logging.info(f"Затримка {REPLICA_DELAY}s перед записом...")
-        time.sleep(REPLICA_DELAY)
-
-    with messages_lock:
-        is_duplicate = any(m["id"] == msg["id"] for m in messages)
-        if not is_duplicate:
-            messages.append(msg)
-            # Total ordering
-            messages.sort(key=lambda m: m["id"])
+    # id ніколи не видаляються з message_ids, тож знайдений без lock id — точно дубль;
+    # для дублів (повторів від Master) немає ні затримки, ні lock.
+    # Для нових повідомлень lock беремо після затримки (і там перевіряємо ще раз)
+    is_duplicate = msg["id"] in message_ids
+    if not is_duplicate:
+        _replica_delay()
+        with messages_lock:
+            is_duplicate = not _insert_locked(msg)
 
     if is_duplicate:
-        logging.info(f"Ігноровано дубль {msg}")
+        logging.info("Ігноровано дубль %s", msg)
     else:
-        logging.info(f"Записано повідомлення {msg}")
+        logging.info("Записано повідомлення %s", msg)
 
     return jsonify({"status": "replicated", "msg": msg}), 200
 
 
+@app.route("/replicate_batch", methods=["POST"])
+def replicate_batch():
+    """
+    Secondary отримує пакет повідомлень від Master: {"messages": [...]}.
+    Та сама логіка, що й у /replicate, але весь пакет записується
+    за одне захоплення messages_lock і одну затримку (лише якщо є нові).
+    """
+    batch = request.get_json()["messages"]
+
+    # Дублі (повтори від Master) відсіюємо без lock і до затримки, як і в /replicate
+    fresh = [msg for msg in batch if msg["id"] not in message_ids]
+    added = 0
+    if fresh:
+        _replica_delay()
+        with messages_lock:
+            added = sum(1 for msg in fresh if _insert_locked(msg))
+
+    logging.info("Записано %d з %d повідомлень пакета", added, len(batch))
+
+    return jsonify({"status": "replicated", "count": added}), 200
+
+
 @app.route("/messages", methods=["GET"])
 def get_messages():
     """Повертає всі повідомлення Secondary"""
+    return Response(_messages_json(), mimetype="application/json")
+
+
+def request_pending_from_master(attempt: int = 1) -> bool:
+    """
+    Просить Master дозвідправити журнал (POST /pending), щоб після рестарту
+    отримати пропущені повідомлення. Master лише приймає запит (202), а сам
+    журнал надсилає у фоні через /replicate_batch. Одна спроба; якщо Master не відповів,
+    наступну ставить threading.Timer, тож між спробами жоден потік не висить.
+    Пауза — full jitter: uniform(0, min(cap, base * 2^(attempt-1))), щоб кілька
+    Secondary, що рестартували разом, не били в Master синхронно.
+    """
+    try:
+        response = _client.post(f"{MASTER_URL}/pending", json={"url": SELF_URL})
+        if response.status_code == 202:
+            logging.info("Master прийняв запит на синхронізацію (спроба %d)", attempt)
+            return True
+        logging.warning("Master відповів %d на /pending (спроба %d)", response.status_code, attempt)
+    except httpx.HTTPError as e:
+        logging.warning("Спроба %d синхронізації з Master не вдалася: %s", attempt, e)
+
+    if attempt >= SYNC_MAX_ATTEMPTS:
+        logging.warning("Не вдалося синхронізуватися з Master після %d спроб", SYNC_MAX_ATTEMPTS)
+        return False
+    delay = random.uniform(0, min(SYNC_MAX_DELAY, SYNC_RETRY_DELAY * 2 ** (attempt - 1)))
+    _schedule_sync_attempt(delay, attempt + 1)
+    return False
+
+
+def _schedule_sync_attempt(delay: float, attempt: int) -> None:
+    timer = threading.Timer(delay, request_pending_from_master, args=(attempt,))
+    timer.daemon = True
+    timer.start()
+
+
+def repair_gap() -> None:
+    """
+    Періодична перевірка пропуску (тіло фонового потоку). Якщо в pending_heap
+    є повідомлення, а next_expected_id не зрушив з попередньої перевірки,
+    пропущені id самі не прийдуть (наприклад, після рестарту Master шле лише
+    нові записи) — забираємо з Master усе, починаючи з next_expected_id.
+    Id, яких немає і на Master, пропускаємо (див. _fetch_from_master).
+    Перевірка повторюється весь час роботи процесу.
+    """
+    last_seen = None
+    while not _gap_repair_stop.wait(GAP_REPAIR_INTERVAL):
+        expected = next_expected_id
+        try:
+            if pending_heap and expected == last_seen:
+                _fetch_from_master(expected)
+        except Exception:
+            logging.exception("Перевірка пропуску з id %d не вдалася", expected)
+        last_seen = expected
+
+
+def _fetch_from_master(from_id: int) -> None:
+    """Дозапитує у Master повідомлення з id >= from_id і записує нові."""
+    try:
+        response = _client.get(f"{MASTER_URL}/messages", params={"from_id": from_id})
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logging.warning("Не вдалося дозапитати пропуск з id %d у Master: %s", from_id, e)
+        return
+    batch = response.json()
     with messages_lock:
-        snapshot = list(messages)
-    return jsonify(snapshot)
+        added = sum(1 for msg in batch if _insert_locked(msg))
+        if next_expected_id == from_id:
+            # Master віддає id >= from_id за зростанням. Якщо from_id серед них немає,
+            # id нижче за найменший отриманий (або за буфер, якщо Master нічого не дав)
+            # на Master не існує — інакше пропуск не закриється ніколи
+            lowest = batch[0]["id"] if batch else (pending_heap[0][0] if pending_heap else None)
+            if lowest is not None and lowest > from_id:
+                _skip_gap_locked(lowest)
+    logging.info("Пропуск з id %d: отримано від Master %d нових повідомлень", from_id, added)
+
+
+def schedule_gap_repair() -> None:
+    """
+    Запускає періодичну перевірку пропуску (з хука сервера, як і синхронізацію).
+    Перевірка постійна, тож це один daemon-потік, а не ланцюжок threading.Timer.
+    """
+    threading.Thread(target=repair_gap, name="gap-repair", daemon=True).start()
+
+
+def schedule_pending_sync() -> None:
+    """
+    Запускає синхронізацію у фоні, щоб не блокувати старт сервера.
+    Викликається з хука сервера (gunicorn.conf.py або __main__), а не під час імпорту.
+    """
+    if not SELF_URL:
+        logging.info("SELF_URL не задано — синхронізацію з Master пропущено")
+        return
+    _schedule_sync_attempt(0, 1)
+
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True, threaded=True)
+    # У контейнері secondary запускається через gunicorn (див. Dockerfile.secondary)
+    schedule_pending_sync()
+    schedule_gap_repair()
+    app.run(host="0.0.0.0", port=5000, threaded=True)